@@ -1,16 +1,23 @@
 #!/usr/bin/env python
 import base64
 import json
+import time
+import urllib.parse
 import requests
-from ratelimit import limits, sleep_and_retry
 from Cryptodome.Cipher import AES
+from limiter import AdaptiveLimiter
 
 
 class NeteaseAPI:
     _AES_OBJ = AES.new(bytes('rFgB&h#%2?^eDg:Q', 'UTF-8'), AES.MODE_ECB)
     _API_URL = 'http://music.163.com/api/linux/forward'
+    # "操作频繁" (405) and "Cheating" (-460) are returned when requesting too fast
+    _THROTTLE_CODES = (405, 429, 503, -460)
+    _THROTTLE_RETRIES = 3
 
     def __init__(self):
+        # The rate budget belongs to the instance, so several accounts can be driven concurrently
+        self.limiter = AdaptiveLimiter()
         self.req = requests.Session()
         self.req.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36' \
                                          ' (KHTML, like Gecko) Chrome/60.0.3112.90 Safari/537.36'
@@ -35,20 +42,42 @@ class NeteaseAPI:
         data_bytes += bytes((pad_length,)) * pad_length
         return base64.b16encode(NeteaseAPI._AES_OBJ.encrypt(data_bytes))
 
-    @sleep_and_retry
-    @limits(calls=2, period=2)
+    @staticmethod
+    def _is_throttled(response, parsed):
+        if response.status_code in NeteaseAPI._THROTTLE_CODES:
+            return True
+        if not isinstance(parsed, dict):
+            return False
+        try:
+            code = int(parsed.get('code', 200))
+        except (TypeError, ValueError):
+            code = 200
+        return code in NeteaseAPI._THROTTLE_CODES or '频繁' in str(parsed.get('msg') or '')
+
     def request(self, url, params, method='POST'):
+        endpoint = urllib.parse.urlparse(url).path
         payload_dict = dict(url=url, method=method, params=params)
         payload_bytes = NeteaseAPI.encrypt(payload_dict)
-        response = self.req.post(NeteaseAPI._API_URL, {'eparams': payload_bytes})
-        try:
-            parsed = json.loads(response.text)
-            msg = parsed.get('msg')
-            if msg:
-                print("MESSAGE: ", msg)
-            return parsed
-        except json.decoder.JSONDecodeError as e:
-            print("ERROR: ", e, response.text)
+        parsed = None
+        for _ in range(NeteaseAPI._THROTTLE_RETRIES):
+            self.limiter.acquire(endpoint)
+            start = time.monotonic()
+            response = self.req.post(NeteaseAPI._API_URL, {'eparams': payload_bytes})
+            latency = time.monotonic() - start
+            try:
+                parsed = json.loads(response.text)
+            except json.decoder.JSONDecodeError as e:
+                print("ERROR: ", e, response.text)
+                parsed = None
+            throttled = NeteaseAPI._is_throttled(response, parsed)
+            # An unparseable response is a server error, which must not speed the limiter up
+            self.limiter.feedback(endpoint, latency, throttled, failed=parsed is None)
+            if isinstance(parsed, dict) and parsed.get('msg'):
+                print("MESSAGE: ", parsed['msg'])
+            if not throttled:
+                return parsed
+        print("ERROR: still throttled after %d attempts: %s" % (NeteaseAPI._THROTTLE_RETRIES, url))
+        return parsed
 
     def dump_cookie(self, path):
         import pickle
@@ -58,6 +87,15 @@ class NeteaseAPI:
         import pickle
         self.req.cookies = pickle.load(open(path, 'rb'))
 
+    def dump_rates(self, path):
+        self.limiter.dump(path)
+
+    def load_rates(self, path):
+        self.limiter.load(path)
+
+    def rate_stats(self):
+        return self.limiter.stats()
+
     def login_cellphone(self, phone, password):
         import hashlib
         URL = 'http://music.163.com/api/login/cellphone'
@@ -128,10 +166,13 @@ class NeteaseApiCli(NeteaseAPI):
         import os
         if os.path.isfile(cookies):
             self.load_cookie(cookies)
+        if os.path.isfile(cookies + '.rates'):
+            self.load_rates(cookies + '.rates')
         self._cookies = cookies
 
     def __del__(self):
         self.dump_cookie(self._cookies)
+        self.dump_rates(self._cookies + '.rates')
 
     def decrypt(self, data):
         return super(NeteaseApiCli, self).decrypt(data)
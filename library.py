@@ -1,9 +1,10 @@
 import os
 import pickle
 import logging
+import threading
 import taglib
-import requests
 from api import NeteaseAPI
+from mirror import MirrorPool
 
 
 # Copyright: Fred Cirera
@@ -23,48 +24,58 @@ class Library:
     DOWNLOAD_STRATEGY_UPGRADE = 1
     DOWNLOAD_SOURCE_PLAY = 0
     DOWNLOAD_SOURCE_DOWNLOAD = 1
+    PLAYER_URL_RETRIES = 1
 
-    def __init__(self, lib_path, api: NeteaseAPI):
+    def __init__(self, lib_path, api: NeteaseAPI, mirrors=None):
         Library.L.debug('Initialization: lib_path = %s', lib_path)
         self._path = os.path.abspath(lib_path)
         self._TRACK_DIR = self._path + '/tracks/'
         self._TMP_DIR = self._path + '/tmp/'
         self._PLAYLIST_DIR = self._path + '/playlists/'
         self._DB_PATH = self._path + '/db.pickle'
+        self._MIRRORS_PATH = self._path + '/mirrors.json'
         for path in (self._TRACK_DIR, self._TMP_DIR, self._PLAYLIST_DIR):
             if not os.path.exists(path):
                 os.mkdir(path)
 
         self._api = api
+        self._mirrors = MirrorPool(mirrors, self._MIRRORS_PATH)
+        self._accounts = dict()
+        # Guards the database, which is shared by the sync threads of all accounts
+        self._lock = threading.RLock()
+        # Tracks being downloaded by any account, so that each one is fetched only once
+        self._queued = set()
+        self._released = threading.Condition(self._lock)
         if os.path.isfile(self._DB_PATH):
             self._db = pickle.load(open(self._DB_PATH, 'rb'))
         else:
             Library.L.debug('Creating empty database')
             self._db = {'playlists': {}, 'local_tracks': {}}
+        # Playlists are shared; accounts only record which ones they own
+        self._db.setdefault('accounts', {})
 
     def save(self):
-        pickle.dump(self._db, open(self._DB_PATH, 'wb'))
+        with self._lock:
+            pickle.dump(self._db, open(self._DB_PATH, 'wb'))
 
-    @staticmethod
-    def download_file(url, path):
-        cdn = '220.243.197.54'
-        url = url.replace('m10.music.126.net', cdn + '/m10.music.126.net')
-        # print(url)
-        r = requests.get(url, stream=True)
-        with open(path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024*1024):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-
-    def sync(self, uid):
+    def add_account(self, uid, api: NeteaseAPI):
+        self._accounts[uid] = api
+
+    def download_file(self, url, path):
+        return self._mirrors.download(url, path)
+
+    def sync(self, uid, api: NeteaseAPI = None):
+        if api is None:
+            api = self._accounts.get(uid, self._api)
         Library.L.info('Syncing for user %d', uid)
         local_playlists = self._db['playlists']
 
-        remote_pids = set()
-        remote_playlists = self._api.get_user_playlist(uid)['playlist']
+        remote_playlists = api.get_user_playlist(uid)['playlist']
+        # Claim the playlists first, so that concurrent syncs won't remove them
+        with self._lock:
+            self._db['accounts'][uid] = {'pids': [p['id'] for p in remote_playlists]}
         for remote_meta in remote_playlists:
             pid = remote_meta['id']
-            remote_pids.add(pid)
 
             should_fetch = False
             if pid not in local_playlists:
@@ -78,18 +89,59 @@ class Library:
                 elif local_playlist['name'] != remote_meta['name']:
                     Library.L.info('Renaming playlist %s -> %s (%d)',
                                    remote_meta['name'], local_playlist['name'], pid)
-                    local_playlist['name'] = remote_meta['name']
+                    with self._lock:
+                        local_playlist['name'] = remote_meta['name']
 
             if should_fetch:
-                detail = self._api.get_playlist_detail(pid)['playlist']
+                detail = api.get_playlist_detail(pid)['playlist']
                 playlist = {'name': remote_meta['name'], 'raw': detail}
                 playlist['tids'] = [t['id'] for t in detail['trackIds']]
-                local_playlists[pid] = playlist
+                with self._lock:
+                    local_playlists[pid] = playlist
+
+        with self._lock:
+            # Forget accounts no longer configured
+            active_uids = set(self._accounts.keys()) | {uid}
+            accounts = self._db['accounts']
+            for stale_uid in set(accounts.keys()) - active_uids:
+                Library.L.info('Forgetting playlists of removed user %d', stale_uid)
+                del accounts[stale_uid]
+            # Playlists of accounts not synced yet are unknown, so prune only when all are known
+            if active_uids - set(accounts.keys()):
+                Library.L.debug('Skipping playlist pruning until all users are synced')
+                return
+            owned_pids = set()
+            for account in accounts.values():
+                owned_pids.update(account['pids'])
+            for pid in set(local_playlists.keys()) - owned_pids:
+                Library.L.info('Removing redundant playlist %s(%d)',
+                               local_playlists[pid]['name'], pid)
+                del local_playlists[pid]
+
+    def sync_accounts(self, download=False, strategy=None, source=None):
+        def sync_account(uid, api):
+            self.sync(uid, api)
+            if not download:
+                return
+            tids = list()
+            for pid in self._db['accounts'][uid]['pids']:
+                tids.extend(self._db['playlists'][pid]['tids'])
+            tids = list(dict.fromkeys(tids))
+            for start in range(0, len(tids), 200):
+                Library.L.info('Downloading for user %d: %d / %d', uid, start, len(tids))
+                self.download_tracks(tids[start:start + 200], strategy, source, api)
+                # Save in case the download progress crashes
+                self.save()
 
-        for pid in set(local_playlists.keys()) - remote_pids:
-            Library.L.info('Removing redundant playlist %s(%d)',
-                           local_playlists[pid]['name'], pid)
-            del local_playlists[pid]
+        if not self._accounts:
+            Library.L.warning('No account to sync')
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(self._accounts)) as executor:
+            futures = [executor.submit(sync_account, uid, api)
+                       for uid, api in self._accounts.items()]
+            for future in futures:
+                future.result()
 
 
     def scan_tracks(self):
@@ -153,7 +205,10 @@ class Library:
             return False
         Library.L.info('Downloading %s: %s, %s', tid, meta['name'], _size_format(size))
         tmp_path = self._TMP_DIR + str(tid) + '.' + ext
-        Library.download_file(url, tmp_path)
+        if not self.download_file(url, tmp_path):
+            Library.L.error('Download failed on all mirrors: %d: %s', tid, meta['name'])
+            os.remove(tmp_path)
+            return False
 
         # Check size and hash
         CHECK_SIZE_TOO_SMALL = 0
@@ -190,22 +245,23 @@ class Library:
         Library.L.debug('Tagging %s', tid)
         Library.tag(tmp_path, meta)
 
-        # Remove old file
-        if tid in self._db['local_tracks']:
-            prev_path = self._TRACK_DIR + str(tid) + '.' + self._db['local_tracks'][tid]['ext']
-            try:
-                os.remove(prev_path)
-            except FileNotFoundError:
-                pass
-        new_path = self._TRACK_DIR + str(tid) + '.' + ext
-        os.rename(tmp_path, new_path)
-
-        # Add to DB
-        local_track = dict(size=os.path.getsize(new_path), ext=ext, bitrate=file_info['br'])
-        self._db['local_tracks'][tid] = local_track
+        with self._lock:
+            # Remove old file
+            if tid in self._db['local_tracks']:
+                prev_path = self._TRACK_DIR + str(tid) + '.' + self._db['local_tracks'][tid]['ext']
+                try:
+                    os.remove(prev_path)
+                except FileNotFoundError:
+                    pass
+            new_path = self._TRACK_DIR + str(tid) + '.' + ext
+            os.rename(tmp_path, new_path)
+
+            # Add to DB
+            local_track = dict(size=os.path.getsize(new_path), ext=ext, bitrate=file_info['br'])
+            self._db['local_tracks'][tid] = local_track
         return True
 
-    def _get_download_info(self, tids, strategy, source):
+    def _get_download_info(self, tids, strategy, source, api):
         local_tracks = self._db['local_tracks']
         # Skip tracks already downloaded: don't fetch the song's detail
         if strategy == Library.DOWNLOAD_STRATEGY_MISSING:
@@ -215,7 +271,7 @@ class Library:
         if not tids:
             return dict(), list(), list()
 
-        details_api = self._api.get_track_detail(list(tids))
+        details_api = api.get_track_detail(list(tids))
         details = {t['id']: dict(meta=t) for t in details_api['songs']}
         for priv in details_api['privileges']:
             if priv['id'] not in details:
@@ -272,29 +328,57 @@ class Library:
                 list_download.append((tid, bitrate_fetch))
         return details, list_play, list_download
 
-    def download_tracks(self, tids, strategy=None, source=None):
+    def download_tracks(self, tids, strategy=None, source=None, api: NeteaseAPI = None):
         strategy = Library.DOWNLOAD_STRATEGY_MISSING if strategy is None else strategy
         source = Library.DOWNLOAD_SOURCE_PLAY if strategy is None else source
-        details, list_play, list_download = self._get_download_info(tids, strategy, source)
+        api = self._api if api is None else api
+
+        # Tracks claimed by another account are deferred, and tried again once released,
+        # in case that account lacks the privilege to fetch them.
+        # Tracks it did fetch are then skipped by the local_tracks check.
+        deferred = list(tids)
+        while deferred:
+            with self._released:
+                while all(tid in self._queued for tid in deferred):
+                    self._released.wait()
+                claimed = [tid for tid in deferred if tid not in self._queued]
+                deferred = [tid for tid in deferred if tid in self._queued]
+                self._queued.update(claimed)
+            try:
+                self._download_claimed_tracks(claimed, strategy, source, api)
+            finally:
+                with self._released:
+                    self._queued.difference_update(claimed)
+                    self._released.notify_all()
+
+    def _download_claimed_tracks(self, tids, strategy, source, api):
+        details, list_play, list_download = self._get_download_info(tids, strategy, source, api)
 
         num_total = len(list_play) + len(list_download)
         num_processed = 1
 
+        retries = dict()
         while list_play:
             # Download play urls in batch
-            for file_info in self._api.get_player_url(list_play)['data']:
+            for file_info in api.get_player_url(list_play)['data']:
                 tid = file_info['id']
                 Library.L.info("Download progress: %d/%d", num_processed, num_total)
                 if self._download_track(tid, file_info, details[tid]['meta']):
                     num_processed += 1
                     list_play.remove(tid)
-                else:
+                elif retries.get(tid, 0) < Library.PLAYER_URL_RETRIES:
+                    retries[tid] = retries.get(tid, 0) + 1
                     Library.L.warning("Retry: fetch the player URL again in case of timeout")
                     break
+                else:
+                    # Give up, so the claim is released and other accounts may try it
+                    Library.L.error("Giving up track %d: %s", tid, details[tid]['meta']['name'])
+                    num_processed += 1
+                    list_play.remove(tid)
 
         # Download API doesn't support batch mode, download one by one
         for tid, bitrate in list_download:
-            file_info = self._api.get_download_url(tid, bitrate)['data']
+            file_info = api.get_download_url(tid, bitrate)['data']
             Library.L.info("Download progress: %d/%d", num_processed, num_total)
             self._download_track(tid, file_info, details[tid]['meta'])
             num_processed += 1
@@ -326,8 +410,14 @@ class Library:
         tagfile.tags['TRACKNUMBER'] = str(detail['no'])
         tagfile.save()
 
-    def _save_tids(self, title: str, tids: list):
-        m3u_path = self._PLAYLIST_DIR + title.replace('/', '／') + '.m3u'
+    def _save_tids(self, title: str, tids: list, uid=None):
+        playlist_dir = self._PLAYLIST_DIR
+        if uid is not None:
+            # Each account gets its own m3u directory
+            playlist_dir += str(uid) + '/'
+            if not os.path.exists(playlist_dir):
+                os.mkdir(playlist_dir)
+        m3u_path = playlist_dir + title.replace('/', '／') + '.m3u'
         m3u_file = open(m3u_path, 'w')
         local_tracks = self._db['local_tracks']
         for tid in tids:
@@ -337,30 +427,72 @@ class Library:
             else:
                 Library.L.warning('Missing file for track %d', tid)
 
-    def save_playlist(self, pid):
+    def save_playlist(self, pid, uid=None):
         playlist = self._db['playlists'][pid]
-        self._save_tids(playlist['name'], playlist['tids'])
+        self._save_tids(playlist['name'], playlist['tids'], uid)
 
 
 class LibraryCli(object):
-    def __init__(self, db_path, cookies_path="cookies"):
+    def __init__(self, db_path, cookies_path="cookies", accounts=None, mirrors=None):
+        ''' accounts: {uid: cookies_path}, e.g. --accounts='{123: "cookies_a", 456: "cookies_b"}'
+            mirrors: CDN IPs tried in order of health, e.g. --mirrors='["220.243.197.54", "direct"]' '''
         self._cookies_name = cookies_path
-        self._api = NeteaseAPI()
-        try:
-            self._api.load_cookie(self._cookies_name)
-        except FileNotFoundError:
-            pass
+        self._api = LibraryCli._load_api(cookies_path)
         self._db_path = db_path
-        self._lib = Library(db_path, self._api)
+        self._lib = Library(db_path, self._api, mirrors)
+        self._accounts = dict()
+        for uid, account_cookies_path in (accounts or {}).items():
+            api = LibraryCli._load_api(account_cookies_path)
+            self._accounts[int(uid)] = (account_cookies_path, api)
+            self._lib.add_account(int(uid), api)
         self._playlists = self._lib._db['playlists']
         self._local_tracks = self._lib._db['local_tracks']
 
     def __del__(self):
         self._api.dump_cookie(self._cookies_name)
+        self._api.dump_rates(self._cookies_name + '.rates')
+        for cookies_path, api in self._accounts.values():
+            api.dump_cookie(cookies_path)
+            api.dump_rates(cookies_path + '.rates')
         self._lib.save()
 
-    def sync(self, uid):
-        self._lib.sync(uid)
+    @staticmethod
+    def _load_api(cookies_path):
+        # Learned rates are kept next to the cookies, as each account has its own budget
+        api = NeteaseAPI()
+        try:
+            api.load_cookie(cookies_path)
+        except FileNotFoundError:
+            pass
+        try:
+            api.load_rates(cookies_path + '.rates')
+        except FileNotFoundError:
+            pass
+        return api
+
+    def sync(self, uid=None, download=False):
+        if uid is not None:
+            self._lib.sync(uid)
+        else:
+            self._lib.sync_accounts(download,
+                                    Library.DOWNLOAD_STRATEGY_UPGRADE,
+                                    Library.DOWNLOAD_SOURCE_PLAY)
+
+    def rates(self):
+        apis = [('default', self._api)]
+        apis += [(uid, api) for uid, (_, api) in self._accounts.items()]
+        for name, api in apis:
+            for endpoint, stat in sorted(api.rate_stats().items()):
+                latency = '-' if stat['latency'] is None else '%.2fs' % stat['latency']
+                print(name, endpoint, '%.2f/s' % stat['rate'], latency,
+                      f"{stat['throttled']}/{stat['calls']} throttled, {stat['failed']} failed")
+
+    def mirrors(self):
+        for mirror, health in self._lib._mirrors.stats().items():
+            latency = '-' if health['latency'] is None else '%.2fs' % health['latency']
+            throughput = '-' if health['throughput'] is None else \
+                _size_format(health['throughput'], 'B/s')
+            print(mirror, latency, throughput, f"{health['failures']} failures")
 
     def cleanup(self):
         import os
@@ -405,9 +537,20 @@ class LibraryCli(object):
 
 
     def m3u(self):
-        for pid, playlist in self._playlists.items():
-            print(pid, playlist['name'])
-            self._lib.save_playlist(pid)
+        if not self._accounts:
+            for pid, playlist in self._playlists.items():
+                print(pid, playlist['name'])
+                self._lib.save_playlist(pid)
+            return
+
+        for uid in self._accounts:
+            account = self._lib._db['accounts'].get(uid)
+            if account is None:
+                print(uid, 'not synced')
+                continue
+            for pid in account['pids']:
+                print(uid, pid, self._playlists[pid]['name'])
+                self._lib.save_playlist(pid, uid)
 
 
 def main():
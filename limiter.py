@@ -0,0 +1,114 @@
+import json
+import time
+import logging
+import threading
+
+
+class AdaptiveLimiter:
+    ''' Per-endpoint token buckets, whose rates are tuned by AIMD from the server's feedback '''
+    L = logging.getLogger('AdaptiveLimiter')
+
+    INITIAL_RATE = 1.0      # calls per second, the former global limit of 2 calls per 2 seconds
+    MIN_RATE = 0.05
+    MAX_RATE = 10.0
+    BURST = 2.0
+    INCREASE = 0.05         # additive increase after each healthy call
+    DECREASE = 0.5          # multiplicative decrease when the server throttles
+    SLOW_DECREASE = 0.9     # milder decrease when a call is much slower than usual
+    SLOW_FACTOR = 3.0
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = dict()
+
+    def _endpoint(self, key):
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = dict(rate=AdaptiveLimiter.INITIAL_RATE, latency=None,
+                            calls=0, throttled=0, failed=0)
+            self._endpoints[key] = endpoint
+        if 'tokens' not in endpoint:
+            endpoint['tokens'] = AdaptiveLimiter.BURST
+            endpoint['stamp'] = time.monotonic()
+        return endpoint
+
+    def acquire(self, key):
+        while True:
+            with self._lock:
+                endpoint = self._endpoint(key)
+                now = time.monotonic()
+                tokens = endpoint['tokens'] + (now - endpoint['stamp']) * endpoint['rate']
+                endpoint['tokens'] = min(AdaptiveLimiter.BURST, tokens)
+                endpoint['stamp'] = now
+                if endpoint['tokens'] >= 1:
+                    endpoint['tokens'] -= 1
+                    return
+                wait = (1 - endpoint['tokens']) / endpoint['rate']
+            time.sleep(wait)
+
+    def feedback(self, key, latency, throttled, failed=False):
+        with self._lock:
+            endpoint = self._endpoint(key)
+            endpoint['calls'] += 1
+            rate = endpoint['rate']
+            mean_latency = endpoint['latency']
+            if throttled:
+                endpoint['throttled'] += 1
+                endpoint['rate'] = max(AdaptiveLimiter.MIN_RATE, rate * AdaptiveLimiter.DECREASE)
+                # Drop the saved burst, so the next call waits for the slower rate
+                endpoint['tokens'] = min(endpoint['tokens'], 0)
+                AdaptiveLimiter.L.info('Throttled on %s: rate %.2f -> %.2f/s',
+                                       key, rate, endpoint['rate'])
+            elif failed:
+                endpoint['failed'] += 1
+                endpoint['rate'] = max(AdaptiveLimiter.MIN_RATE, rate * AdaptiveLimiter.SLOW_DECREASE)
+                AdaptiveLimiter.L.info('Failed response on %s: rate %.2f -> %.2f/s',
+                                       key, rate, endpoint['rate'])
+                return
+            elif mean_latency is not None and latency > mean_latency * AdaptiveLimiter.SLOW_FACTOR:
+                endpoint['rate'] = max(AdaptiveLimiter.MIN_RATE, rate * AdaptiveLimiter.SLOW_DECREASE)
+                AdaptiveLimiter.L.debug('Slow response on %s (%.2fs, mean %.2fs): rate %.2f -> %.2f/s',
+                                        key, latency, mean_latency, rate, endpoint['rate'])
+            else:
+                endpoint['rate'] = min(AdaptiveLimiter.MAX_RATE, rate + AdaptiveLimiter.INCREASE)
+
+            if mean_latency is None:
+                endpoint['latency'] = latency
+            else:
+                weight = AdaptiveLimiter.LATENCY_WEIGHT
+                endpoint['latency'] = mean_latency * (1 - weight) + latency * weight
+
+    def stats(self):
+        with self._lock:
+            return {key: dict(rate=e['rate'], latency=e['latency'],
+                              calls=e['calls'], throttled=e['throttled'], failed=e['failed'])
+                    for key, e in self._endpoints.items()}
+
+    def dump(self, path):
+        # Only the learned rates are kept; counters restart with each run
+        learned = {key: dict(rate=e['rate'], latency=e['latency'])
+                   for key, e in self.stats().items()}
+        json.dump(learned, open(path, 'w'), indent=2)
+
+    def load(self, path):
+        # A run killed while saving may leave a truncated file; start afresh then
+        try:
+            learned = json.load(open(path))
+            rates = dict()
+            for key, e in learned.items():
+                rate = float(e['rate'])
+                latency = e.get('latency')
+                latency = None if latency is None else float(latency)
+                # NaN fails every comparison, so check for the valid range instead
+                if not rate > 0 or not (latency is None or latency >= 0):
+                    raise ValueError('invalid rate %r or latency %r for %s' % (rate, latency, key))
+                rates[key] = (rate, latency)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            AdaptiveLimiter.L.warning('Ignoring unreadable rates %s: %s', path, e)
+            return
+        with self._lock:
+            for key, (rate, latency) in rates.items():
+                rate = min(AdaptiveLimiter.MAX_RATE, max(AdaptiveLimiter.MIN_RATE, rate))
+                self._endpoints[key] = dict(rate=rate, latency=latency,
+                                            calls=0, throttled=0, failed=0)
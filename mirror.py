@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import logging
+import threading
+import requests
+
+
+class _Stalled(Exception):
+    pass
+
+
+class _Watchdog(threading.Thread):
+    ''' Closes a response whose throughput over the last window is too low '''
+
+    def __init__(self, response, window, threshold):
+        super(_Watchdog, self).__init__(daemon=True)
+        self.received = 0
+        self.stalled = None
+        self._response = response
+        self._window = window
+        self._threshold = threshold
+        self._done = threading.Event()
+
+    def run(self):
+        window_start, window_received = time.monotonic(), 0
+        # Checked on the wall clock, as a trickling read may not return for a long time
+        while not self._done.wait(self._window):
+            now, received = time.monotonic(), self.received
+            throughput = (received - window_received) / (now - window_start)
+            if throughput < self._threshold:
+                self.stalled = throughput
+                self._response.close()
+                return
+            window_start, window_received = now, received
+
+    def stop(self):
+        self._done.set()
+
+
+class MirrorPool:
+    ''' CDN mirrors for m10.music.126.net, ranked by probed and observed health '''
+    L = logging.getLogger('MirrorPool')
+
+    HOST = 'm10.music.126.net'
+    DIRECT = 'direct'           # fetch from the original host without rewriting
+    DEFAULT_MIRRORS = ('220.243.197.54', DIRECT)
+
+    PROBE_INTERVAL = 3600
+    PROBE_BYTES = 64 * 1024
+    TIMEOUT = (5, 15)           # connect, read; the read timeout catches complete stalls
+    STALL_WINDOW = 10           # seconds over which the throughput is checked
+    STALL_THROUGHPUT = 16 * 1024
+    MAX_FAILURES = 3            # consecutive failures before a mirror is deemed unhealthy
+    MAX_ATTEMPTS = 6
+    WEIGHT = 0.3
+    CHUNK_SIZE = 64 * 1024
+    TYPICAL_SIZE = 8 * 1024 * 1024  # weighs latency against throughput when ranking
+
+    def __init__(self, mirrors=None, state_path=None):
+        if mirrors is None:
+            mirrors = MirrorPool.DEFAULT_MIRRORS
+        elif isinstance(mirrors, str):
+            mirrors = [mirrors]
+        self._mirrors = [str(mirror) for mirror in mirrors]
+        if not self._mirrors:
+            raise ValueError('No CDN mirror configured')
+        self._state_path = state_path
+        self._lock = threading.Lock()
+        self._health = dict()
+        saved = dict()
+        if state_path is not None and os.path.isfile(state_path):
+            # A run killed while saving may leave a truncated file; start afresh then
+            try:
+                saved = json.load(open(state_path))
+                if not isinstance(saved, dict):
+                    raise ValueError('not a dict')
+            except ValueError as e:
+                MirrorPool.L.warning('Ignoring unreadable mirror health %s: %s', state_path, e)
+                saved = dict()
+        for mirror in self._mirrors:
+            health = dict(latency=None, throughput=None, failures=0, probed=0)
+            if isinstance(saved.get(mirror), dict):
+                health.update(saved[mirror])
+            self._health[mirror] = health
+
+    def save(self):
+        if self._state_path is None:
+            return
+        with self._lock:
+            json.dump(self._health, open(self._state_path, 'w'), indent=2)
+
+    @staticmethod
+    def rewrite(url, mirror):
+        if mirror == MirrorPool.DIRECT:
+            return url
+        return url.replace(MirrorPool.HOST, mirror + '/' + MirrorPool.HOST)
+
+    def _score(self, mirror):
+        health = self._health[mirror]
+        healthy = health['failures'] < MirrorPool.MAX_FAILURES
+        if not health['throughput']:
+            return healthy, 0
+        # Effective speed for a typical track, including the time to the first byte
+        seconds = (health['latency'] or 0) + MirrorPool.TYPICAL_SIZE / health['throughput']
+        return healthy, MirrorPool.TYPICAL_SIZE / seconds / (1 + health['failures'])
+
+    def ranked(self):
+        with self._lock:
+            return sorted(self._mirrors, key=self._score, reverse=True)
+
+    def record(self, mirror, latency=None, throughput=None, failed=False):
+        with self._lock:
+            health = self._health[mirror]
+            if failed:
+                health['failures'] += 1
+                return
+            health['failures'] = 0
+            for key, value in (('latency', latency), ('throughput', throughput)):
+                if value is None:
+                    continue
+                if health[key] is None:
+                    health[key] = value
+                else:
+                    health[key] = health[key] * (1 - MirrorPool.WEIGHT) + value * MirrorPool.WEIGHT
+
+    @staticmethod
+    def _url_rejected(response):
+        # 4xx means the URL itself is expired or forbidden, which is no fault of the mirror
+        return 400 <= response.status_code < 500
+
+    def probe(self, url):
+        ''' Fetch the head of url from each mirror not probed recently '''
+        now = time.time()
+        for mirror in self._mirrors:
+            with self._lock:
+                health = self._health[mirror]
+                if now - health['probed'] < MirrorPool.PROBE_INTERVAL:
+                    continue
+                health['probed'] = now
+            headers = {'Range': 'bytes=0-%d' % (MirrorPool.PROBE_BYTES - 1)}
+            start = time.monotonic()
+            r = None
+            try:
+                r = requests.get(MirrorPool.rewrite(url, mirror), headers=headers,
+                                 stream=True, timeout=MirrorPool.TIMEOUT)
+                if MirrorPool._url_rejected(r):
+                    MirrorPool.L.warning('Probe skipped, URL rejected with HTTP %d', r.status_code)
+                    with self._lock:
+                        health['probed'] = 0
+                    return
+                r.raise_for_status()
+                latency = time.monotonic() - start
+                received = 0
+                for chunk in r.iter_content(chunk_size=MirrorPool.CHUNK_SIZE):
+                    received += len(chunk)
+                    if received >= MirrorPool.PROBE_BYTES:
+                        break
+                throughput = received / max(time.monotonic() - start - latency, 1e-3)
+            except requests.RequestException as e:
+                MirrorPool.L.warning('Probe failed: %s: %s', mirror, e)
+                self.record(mirror, failed=True)
+                continue
+            finally:
+                if r is not None:
+                    r.close()
+            MirrorPool.L.debug('Probed %s: latency = %.2fs, throughput = %.0fB/s',
+                               mirror, latency, throughput)
+            self.record(mirror, latency, throughput)
+
+    def download(self, url, path):
+        if MirrorPool.HOST in url:
+            self.probe(url)
+            mirrors = self.ranked()
+        else:
+            mirrors = [MirrorPool.DIRECT]
+
+        written = 0
+        succeeded = False
+        with open(path, 'wb') as f:
+            for attempt in range(MirrorPool.MAX_ATTEMPTS):
+                mirror = mirrors[attempt % len(mirrors)]
+                # Resume from where the previous mirror stopped
+                headers = {'Range': 'bytes=%d-' % written} if written else {}
+                start = time.monotonic()
+                received = 0
+                r = None
+                watchdog = None
+                try:
+                    r = requests.get(MirrorPool.rewrite(url, mirror), headers=headers,
+                                     stream=True, timeout=MirrorPool.TIMEOUT)
+                    if written and r.status_code == 416:
+                        # The previous mirror dropped after sending the last byte
+                        succeeded = True
+                        break
+                    if MirrorPool._url_rejected(r):
+                        MirrorPool.L.error('Download URL rejected with HTTP %d', r.status_code)
+                        break
+                    r.raise_for_status()
+                    latency = time.monotonic() - start
+                    if written and r.status_code != 206:
+                        MirrorPool.L.debug('Range unsupported by %s, restarting', mirror)
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+                    watchdog = _Watchdog(r, MirrorPool.STALL_WINDOW, MirrorPool.STALL_THROUGHPUT)
+                    watchdog.start()
+                    try:
+                        for chunk in r.iter_content(chunk_size=MirrorPool.CHUNK_SIZE):
+                            if chunk: # filter out keep-alive new chunks
+                                f.write(chunk)
+                                written += len(chunk)
+                                received += len(chunk)
+                                watchdog.received = received
+                    except Exception:
+                        # Closing the response from the watchdog may surface as any error
+                        if watchdog.stalled is None:
+                            raise
+                    if watchdog.stalled is not None:
+                        raise _Stalled('%.0fB/s over the last %ds' %
+                                       (watchdog.stalled, MirrorPool.STALL_WINDOW))
+                except (requests.RequestException, _Stalled) as e:
+                    MirrorPool.L.warning('Download failed on %s at %d bytes: %s', mirror, written, e)
+                    self.record(mirror, failed=True)
+                    continue
+                finally:
+                    if watchdog is not None:
+                        watchdog.stop()
+                    if r is not None:
+                        r.close()
+                throughput = received / max(time.monotonic() - start, 1e-3)
+                self.record(mirror, latency, throughput)
+                succeeded = True
+                break
+        self.save()
+        return succeeded
+
+    def stats(self):
+        with self._lock:
+            return {mirror: dict(self._health[mirror]) for mirror in self._mirrors}